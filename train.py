@@ -1,19 +1,18 @@
 import os
-import sys
-import math
 import argparse
+import contextlib
 import json
 from pathlib import Path
 import webdataset as wds
 import torch
 print(torch.__version__)
-from numpy import mean as npmean
 import torch.backends.cudnn as cudnn
-import torchvision.transforms as transforms
+import torch.distributed as dist
+import torchvision.transforms.v2 as transforms
+from torchvision.transforms.functional import InterpolationMode
 from torchvision.datasets import ImageFolder
-from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torchvision.utils import save_image
 
 import tae
 import util.misc as misc
@@ -26,16 +25,20 @@ def get_args_parser():
     parser.add_argument('--accum_iter', default=1, type=int, help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
     parser.add_argument('--save_prefix', default="", type=str, help="""prefix for saving checkpoint and log files""")
     parser.add_argument('--save_freq', default=10000, type=int, help='Save checkpoint every this many iterations.')
+    parser.add_argument('--flush_freq', default=100, type=int, help='Move buffered losses to the host and check them for divergence every this many iterations.')
 
     # Model parameters
     parser.add_argument('--model', default='', type=str, help='Name of model to train')
     parser.add_argument('--ckpt', default='', help='resume from a checkpoint')
     parser.add_argument('--input_size', default=224, type=int, help='images input size')
     parser.add_argument('--compile', action='store_true', help='whether to compile the model for improved efficiency (default: false)')
+    parser.add_argument('--compile_mode', default='default', type=str, choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode (default: default)')
+    parser.add_argument('--amp_dtype', default='fp16', type=str, choices=['fp16', 'bf16'], help='dtype for mixed precision training; bf16 needs no loss scaling (default: fp16)')
     parser.add_argument('--display', action='store_true', help='whether to display reconstruction at regular intervals.')
 
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05, help='weight decay (default: 0.05)')
+    parser.add_argument('--clip_grad', type=float, default=None, help='clip gradient norm (default: None, no clipping)')
     parser.add_argument('--max_lr', type=float, default=0.0001, help='max learning rate')
     parser.add_argument('--min_lr', type=float, default=0.00001, help='min learning rate')
     parser.add_argument('--switch_it', type=float, default=900000, help='iteration at which to switch to lower lr')
@@ -47,6 +50,7 @@ def get_args_parser():
     parser.add_argument('--output_dir', default='./output_dir', help='path where to save, empty for no saving')
     parser.add_argument('--device', default='cuda', help='device to use for training/testing')
     parser.add_argument('--num_workers', default=16, type=int)
+    parser.add_argument('--gpu_decode', action='store_true', help='whether to decode and augment the training jpegs on the gpu with nvjpeg; images nvjpeg rejects are decoded on the cpu (default: false)')
     parser.add_argument('--jitter_scale', default=[0.2, 1.0], type=float, nargs="+")
     parser.add_argument('--jitter_ratio', default=[3.0/4.0, 4.0/3.0], type=float, nargs="+")
 
@@ -64,42 +68,58 @@ def main(args):
     device = torch.device(args.device)
     cudnn.benchmark = True
 
-    # validation transforms
+    # bf16 has the same exponent range as fp32, so it does not need loss scaling
+    amp_dtype = misc.get_amp_dtype(args.amp_dtype)
+
+    # validation transforms (images are kept as uint8 here, normalization happens on the gpu)
     val_transform = transforms.Compose([
-        transforms.Resize(args.input_size + 32, interpolation=3),
+        transforms.PILToTensor(),
+        transforms.Resize(args.input_size + 32, interpolation=InterpolationMode.BICUBIC, antialias=True),
         transforms.CenterCrop(args.input_size),
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
     ])
 
     # training transforms
     train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(args.input_size, scale=args.jitter_scale, ratio=args.jitter_ratio, interpolation=3),
+        transforms.PILToTensor(),
+        transforms.RandomResizedCrop(args.input_size, scale=args.jitter_scale, ratio=args.jitter_ratio, interpolation=InterpolationMode.BICUBIC, antialias=True),
         transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
     ])
 
+    # persistent_workers and prefetch_factor are only valid with worker processes (num_workers > 0)
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+
     # train and val datasets and loaders
-    train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode("pil").to_tuple("jpg", "cls").map_tuple(train_transform, lambda x: x)
-    train_loader = wds.WebLoader(train_dataset, batch_size=args.batch_size_per_gpu, num_workers=args.num_workers)
+    if args.gpu_decode:
+        # workers only shuffle and collate the encoded jpegs, decoding and augmentation happen on the gpu
+        # (decoded images differ in size, so only the crop runs per image; the flip runs on the whole batch)
+        gpu_train_transform = transforms.RandomResizedCrop(args.input_size, scale=args.jitter_scale, ratio=args.jitter_ratio, interpolation=InterpolationMode.BICUBIC, antialias=True)
+        train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode().to_tuple("jpg", "cls").batched(args.batch_size_per_gpu, collation_fn=misc.jpeg_collate)
+        train_loader = wds.WebLoader(train_dataset, batch_size=None, num_workers=args.num_workers, pin_memory=True, **worker_kwargs)
+        train_loader = misc.CudaPrefetchLoader(train_loader, device, channels_last=True, gpu_decode=True, transform=gpu_train_transform, batch_transform=misc.BatchRandomHorizontalFlip())
+    else:
+        train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode("pil").to_tuple("jpg", "cls").map_tuple(train_transform, lambda x: x).batched(args.batch_size_per_gpu, collation_fn=misc.fast_collate)
+        train_loader = wds.WebLoader(train_dataset, batch_size=None, num_workers=args.num_workers, pin_memory=True, **worker_kwargs)
+        train_loader = misc.CudaPrefetchLoader(train_loader, device, channels_last=True)
 
     val_dataset = ImageFolder(args.val_data_path, transform=val_transform)
-    val_sampler = SequentialSampler(val_dataset)
-    val_loader = DataLoader(val_dataset, sampler=val_sampler, batch_size=8*args.batch_size_per_gpu, num_workers=args.num_workers, pin_memory=True, drop_last=False)  # note we use a larger batch size for eval
+    val_sampler = DistributedSampler(val_dataset, num_replicas=misc.get_world_size(), rank=misc.get_rank(), shuffle=False)  # each rank evaluates its own shard
+    val_loader = DataLoader(val_dataset, sampler=val_sampler, batch_size=8*args.batch_size_per_gpu, num_workers=args.num_workers, pin_memory=True, **worker_kwargs, drop_last=False, collate_fn=misc.fast_collate)  # note we use a larger batch size for eval
+    val_loader = misc.CudaPrefetchLoader(val_loader, device, channels_last=True)
 
     print(f"Train and val data loaded.")
 
     # define the model
     model = tae.__dict__[args.model]()
-    model.to(device)
+    model.to(device, memory_format=torch.channels_last)  # nhwc layout for the patch embedding conv
     model_without_ddp = model
 
-    # optionally compile model
-    if args.compile:
-        model = torch.compile(model)
+    # static_graph lets DDP reuse the same bucketing/allreduce schedule every iteration; its bookkeeping on the first
+    # backward ignores no_sync, so it is only safe without gradient accumulation
+    model = DDP(model, device_ids=[args.gpu], static_graph=args.accum_iter == 1, gradient_as_bucket_view=True)  # TODO: try FSDP
 
-    model = DDP(model, device_ids=[args.gpu])  # TODO: try FSDP
+    # optionally compile model (compile after wrapping with DDP, so that dynamo can overlap allreduce with the backward pass)
+    if args.compile:
+        model = torch.compile(model, mode=args.compile_mode)
     
     print(f"Model: {model_without_ddp}")
     print(f"Number of params (M): {(sum(p.numel() for p in model_without_ddp.parameters() if p.requires_grad) / 1.e6)}")
@@ -107,13 +127,19 @@ def main(args):
     # set wd as 0 for bias and norm layers
     param_groups = misc.add_weight_decay(model_without_ddp, args.weight_decay, bias_wd=False)
     optimizer = torch.optim.AdamW(param_groups, lr=args.max_lr, betas=(0.9, 0.95), fused=True)  # setting fused True for faster updates (hopefully)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=amp_dtype == torch.float16)
 
     misc.load_model(args.ckpt, model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
     
     model.train()
     metric_logger = misc.MetricLogger(delimiter="  ")
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
+
+    # losses are kept on the gpu and only moved to the host when logging (avoids a device sync per iteration)
+    loss_buf = []
+
+    # reduce-overhead and max-autotune use cuda graphs, whose output buffers are overwritten by the next replay
+    clone_loss = args.compile and args.compile_mode != 'default'
 
     best_eval_loss = 100.0
 
@@ -129,33 +155,34 @@ def main(args):
 
         # optionally pick 8 examples for display and softmax estimation at regular intervals
         if args.display and it % args.save_freq == 0:
-            samples_for_display_and_softmax = samples[:8, ...]
+            samples_for_display_and_softmax = samples[:8, ...].clone()
 
-        samples = samples.to(device, non_blocking=True)
+        # skip the gradient allreduce on accumulation steps (no_sync has to cover the forward pass too)
+        update_grad = (it + 1) % args.accum_iter == 0
+        with contextlib.nullcontext() if update_grad else model.no_sync():
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
+                loss, _ = model(samples)
 
-        with torch.cuda.amp.autocast():
-            loss, _ = model(samples)
+            loss_buf.append(loss.detach().clone() if clone_loss else loss.detach())
 
-        loss_value = loss.item()
+            if args.accum_iter > 1:
+                loss = loss / args.accum_iter
+            loss_scaler(loss, optimizer, clip_grad=args.clip_grad, parameters=model.parameters(), update_grad=update_grad)
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+        if update_grad:
+            optimizer.zero_grad(set_to_none=True)
 
-        loss = loss / args.accum_iter
-        loss_scaler(loss, optimizer, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
-        if (it + 1) % args.accum_iter == 0:
-            optimizer.zero_grad()
+        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
-        torch.cuda.synchronize()
+        # flush buffered losses to the host at a bounded cadence, so a diverging run stops early
+        if (it + 1) % args.flush_freq == 0 or (it != 0 and it % args.save_freq == 0):
+            for loss_value in misc.flush_losses(loss_buf):
+                metric_logger.update(loss=loss_value)
 
-        metric_logger.update(loss=loss_value)
-        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-        
         if it != 0 and it % args.save_freq == 0:
             # estimate eval loss
             print(f"Iteration {it}, evaluating ...")
-            eval_loss = evaluate(val_loader, model_without_ddp, device)
+            eval_loss = evaluate(val_loader, model_without_ddp, device, amp_dtype)
 
             # save checkpoint only if eval_loss decreases
             if eval_loss < best_eval_loss:
@@ -183,9 +210,9 @@ def main(args):
 
             # optionally display some reconstructions
             if args.display:
+                from torchvision.utils import save_image
                 with torch.no_grad():
-                    samples_for_display_and_softmax = samples_for_display_and_softmax.to(device, non_blocking=True)
-                    with torch.cuda.amp.autocast():
+                    with torch.cuda.amp.autocast(dtype=amp_dtype):
                         _, pred = model_without_ddp(samples_for_display_and_softmax)
                         pred = model_without_ddp.unpatchify(pred)
                         
@@ -201,23 +228,25 @@ def main(args):
             model.train()
 
 @torch.no_grad()
-def evaluate(data_loader, model, device):
+def evaluate(data_loader, model, device, amp_dtype=torch.float16):
     # switch to eval mode
     model.eval()
 
-    eval_loss = []
+    # sum of per-sample losses and number of samples on this rank's shard
+    eval_loss = torch.zeros(2, dtype=torch.float64, device=device)
 
     for _, (samples, _) in enumerate(data_loader):
-        samples = samples.to(device, non_blocking=True)
-
         # compute loss
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(dtype=amp_dtype):
             loss, _ = model(samples)
 
-        loss_value = loss.item()
-        eval_loss.append(loss_value)
+        eval_loss[0] += loss.double() * samples.shape[0]
+        eval_loss[1] += samples.shape[0]
 
-    eval_loss = npmean(eval_loss)
+    # gather the stats from all processes
+    if misc.is_dist_avail_and_initialized():
+        dist.all_reduce(eval_loss)
+    eval_loss = (eval_loss[0] / eval_loss[1]).item()
     print(f"Current eval loss: {eval_loss}")
 
     return eval_loss
@@ -1,6 +1,4 @@
 import os
-import sys
-import math
 import argparse
 import json
 from pathlib import Path
@@ -24,20 +22,25 @@ def get_args_parser():
     parser.add_argument('--batch_size', default=256, type=int, help='Total batch size')
     parser.add_argument('--accum_iter', default=1, type=int, help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
     parser.add_argument('--save_prefix', default="", type=str, help='Prefix for saving checkpoint and log files')
+    parser.add_argument('--flush_freq', default=100, type=int, help='Move buffered losses to the host and check them for divergence every this many iterations.')
 
     # Model parameters
     parser.add_argument('--model', default='', type=str, help='Name of model to train')
     parser.add_argument('--model_ckpt', default='', type=str, help='Model checkpoint to resume from')
     parser.add_argument('--num_classes', default=None, type=int, help='Number of classes')
     parser.add_argument('--input_size', default=224, type=int, help='Images input size')
+    parser.add_argument('--amp_dtype', default='fp16', type=str, choices=['fp16', 'bf16'], help='Dtype for mixed precision training; bf16 needs no loss scaling (default: fp16)')
 
     # Encoder parameters
     parser.add_argument('--encoder', default='', type=str, help='Name of encoder')
     parser.add_argument('--encoder_ckpt', default='', type=str, help='Encoder checkpoint to resume from')
+    parser.add_argument('--single_gpu', action='store_true', help='Whether to put the encoder and the model on the same gpu (default: false)')
 
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05, help='Weight decay (default: 0.05)')
+    parser.add_argument('--clip_grad', type=float, default=None, help='Clip gradient norm (default: None, no clipping)')
     parser.add_argument('--lr', type=float, default=0.001, help='Learning rate (absolute lr)')
+    parser.add_argument('--label_smoothing', type=float, default=0.1, help='Label smoothing for the training loss (default: 0.1)')
 
     # Dataset parameters
     parser.add_argument('--train_data_path', default='', type=str)
@@ -61,41 +64,47 @@ def main(args):
     print("{}".format(args).replace(', ', ',\n'))
     cudnn.benchmark = True
 
+    # encoder and model are on separate gpus by default, with --single_gpu there is no inter-gpu copy of the encoder outputs
     device_encoder = torch.device('cuda:0')
-    device_model = torch.device('cuda:1')
+    device_model = torch.device('cuda:0') if args.single_gpu else torch.device('cuda:1')
 
-    # validation transforms
+    # bf16 has the same exponent range as fp32, so it does not need loss scaling
+    amp_dtype = misc.get_amp_dtype(args.amp_dtype)
+
+    # validation transforms (images are kept as uint8 here, normalization happens on the gpu)
     val_transform = transforms.Compose([
         transforms.Resize(args.input_size + 32, interpolation=InterpolationMode.BILINEAR),
         transforms.CenterCrop(args.input_size),
         transforms.PILToTensor(),
-        transforms.ToDtype(torch.float, scale=True),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
         transforms.ToPureTensor()
     ])
 
-    # training transforms
+    # training transforms (mixup/cutmix need float images, but these are left in [0, 255] and normalized on the gpu)
     train_transform = transforms.Compose([
         transforms.RandomResizedCrop(args.input_size, scale=[0.2, 1.0], ratio=[3.0/4.0, 4.0/3.0], interpolation=InterpolationMode.BILINEAR),
         transforms.RandomHorizontalFlip(),
         transforms.RandAugment(interpolation=InterpolationMode.BILINEAR),
         transforms.PILToTensor(),
-        transforms.ToDtype(torch.float, scale=True),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+        transforms.ToDtype(torch.float, scale=False),
         transforms.ToPureTensor()
     ])
 
     mixup_cutmix = get_mixup_cutmix(mixup_alpha=0.2, cutmix_alpha=1.0, num_classes=args.num_classes)
     def collate_fn(batch): return mixup_cutmix(*default_collate(batch))
     
+    # persistent_workers and prefetch_factor are only valid with worker processes (num_workers > 0)
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+
     # train and val datasets and loaders
     train_dataset = ImageFolder(args.train_data_path, transform=train_transform)
     train_sampler = RandomSampler(train_dataset)
-    train_loader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, drop_last=False, collate_fn=collate_fn)
+    train_loader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, **worker_kwargs, drop_last=False, collate_fn=collate_fn)
+    train_loader = misc.CudaPrefetchLoader(train_loader, device_encoder, channels_last=True)
 
     val_dataset = ImageFolder(args.val_data_path, transform=val_transform)
     val_sampler = SequentialSampler(val_dataset)
-    val_loader = DataLoader(val_dataset, sampler=val_sampler, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, drop_last=False)
+    val_loader = DataLoader(val_dataset, sampler=val_sampler, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True, **worker_kwargs, drop_last=False)
+    val_loader = misc.CudaPrefetchLoader(val_loader, device_encoder, channels_last=True)
     print(f"Train and val data loaded.")
 
     # define the model (a bit ugly and hacky atm)
@@ -109,7 +118,7 @@ def main(args):
 
     # define the encoder
     encoder = tae.__dict__[args.encoder]()
-    encoder.to(device_encoder)
+    encoder.to(device_encoder, memory_format=torch.channels_last)  # nhwc layout for the patch embedding conv
     encoder.eval()
     print(f"Model: {encoder}")
     print(f"Number of params (M): {(sum(p.numel() for p in encoder.parameters() if p.requires_grad) / 1.e6)}")
@@ -118,8 +127,9 @@ def main(args):
     param_groups = misc.add_weight_decay(model, args.weight_decay, bias_wd=False)
     optimizer = torch.optim.AdamW(param_groups, lr=args.lr, betas=(0.9, 0.95), fused=True)  # setting fused True for faster updates (hopefully)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=90, gamma=0.1)
-    criterion = torch.nn.CrossEntropyLoss(label_smoothing=0.1)
-    loss_scaler = NativeScaler()
+    criterion = torch.nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+    val_criterion = torch.nn.CrossEntropyLoss()  # eval loss is reported without label smoothing
+    loss_scaler = NativeScaler(enabled=amp_dtype == torch.float16)
 
     # optionally load model and encoder (a bit ugly and hacky atm)
     misc.load_model(args.model_ckpt, model, optimizer=optimizer, loss_scaler=loss_scaler)
@@ -129,7 +139,10 @@ def main(args):
 
     model.train()
     metric_logger = misc.MetricLogger(delimiter="  ")
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
+
+    # losses are kept on the gpu and only moved to the host when logging (avoids a device sync per iteration)
+    loss_buf = []
 
     best_eval_acc1 = 0.0
 
@@ -137,36 +150,37 @@ def main(args):
     for epoch in range(args.epochs):
         for it, (samples, targets) in enumerate(train_loader):
             with torch.no_grad():
-                with torch.cuda.amp.autocast():
-                    samples = samples.to(device_encoder, non_blocking=True)
+                with torch.cuda.amp.autocast(dtype=amp_dtype):
                     samples = encoder.forward_encoder(samples)
 
             # move to other gpu
             samples = samples.to(device_model, non_blocking=True)
             targets = targets.to(device_model, non_blocking=True)
 
-            with torch.cuda.amp.autocast():
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
                 outputs = model(samples)
                 loss = criterion(outputs, targets)
-            
-            loss_value = loss.item()
 
-            if not math.isfinite(loss_value):
-                print("Loss is {}, stopping training".format(loss_value))
-                sys.exit(1)
+            loss_buf.append(loss.detach())
 
-            loss = loss / args.accum_iter
-            loss_scaler(loss, optimizer, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
+            if args.accum_iter > 1:
+                loss = loss / args.accum_iter
+            loss_scaler(loss, optimizer, clip_grad=args.clip_grad, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
             if (it + 1) % args.accum_iter == 0:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
-            torch.cuda.synchronize()
+            # flush buffered losses to the host at a bounded cadence, so a diverging run stops early
+            if (it + 1) % args.flush_freq == 0:
+                for loss_value in misc.flush_losses(loss_buf):
+                    metric_logger.update(loss=loss_value)
 
+        # flush what is left from the end of the epoch
+        for loss_value in misc.flush_losses(loss_buf):
             metric_logger.update(loss=loss_value)
 
         # estimate eval loss
         print(f"Iteration {it}, evaluating ...")
-        test_stats = evaluate(val_loader, model, encoder, device_model, device_encoder)
+        test_stats = evaluate(val_loader, model, encoder, val_criterion, device_model, device_encoder, amp_dtype)
         
         # save checkpoint only if eval_loss decreases
         if test_stats['acc1'] > best_eval_acc1:
@@ -206,9 +220,8 @@ def main(args):
         scheduler.step()
 
 @torch.no_grad()
-def evaluate(val_loader, model, encoder, device_model, device_encoder):
+def evaluate(val_loader, model, encoder, criterion, device_model, device_encoder, amp_dtype=torch.float16):
 
-    criterion = torch.nn.CrossEntropyLoss()
     metric_logger = misc.MetricLogger(delimiter="  ")
 
     # switch model to eval mode
@@ -216,8 +229,7 @@ def evaluate(val_loader, model, encoder, device_model, device_encoder):
 
     for _, (samples, targets) in enumerate(val_loader):
 
-        with torch.cuda.amp.autocast():
-            samples = samples.to(device_encoder, non_blocking=True)
+        with torch.cuda.amp.autocast(dtype=amp_dtype):
             samples = encoder.forward_encoder(samples)
 
         # move to gpu
@@ -225,7 +237,7 @@ def evaluate(val_loader, model, encoder, device_model, device_encoder):
         targets = targets.to(device_model, non_blocking=True)
 
         # compute loss
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(dtype=amp_dtype):
             outputs = model(samples)
             loss = criterion(outputs, targets)
 
@@ -1,6 +1,4 @@
 import os
-import sys
-import math
 import argparse
 import json
 from pathlib import Path
@@ -8,9 +6,8 @@ import torch
 print(torch.__version__)
 import torch.backends.cudnn as cudnn
 import webdataset as wds
-import torchvision.transforms as transforms
-from torchvision.datasets import ImageFolder
-from torch.utils.data import DataLoader, SequentialSampler
+import torchvision.transforms.v2 as transforms
+from torchvision.transforms.functional import InterpolationMode
 
 import tae
 import util.misc as misc
@@ -23,27 +20,33 @@ def get_args_parser():
     parser.add_argument('--accum_iter', default=1, type=int, help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
     parser.add_argument('--save_prefix', default="", type=str, help='Prefix for saving checkpoint and log files')
     parser.add_argument('--save_freq', default=10000, type=int, help='Save checkpoint every this many iterations.')
+    parser.add_argument('--flush_freq', default=100, type=int, help='Move buffered losses to the host and check them for divergence every this many iterations.')
 
     # Model parameters
     parser.add_argument('--model', default='', type=str, help='Name of model to train')
     parser.add_argument('--model_ckpt', default='', type=str, help='Model checkpoint to resume from')
     parser.add_argument('--num_classes', default=None, type=int, help='Number of classes')
     parser.add_argument('--input_size', default=224, type=int, help='Images input size')
+    parser.add_argument('--amp_dtype', default='fp16', type=str, choices=['fp16', 'bf16'], help='Dtype for mixed precision training; bf16 needs no loss scaling (default: fp16)')
 
     # Encoder parameters
     parser.add_argument('--encoder', default='', type=str, help='Name of encoder')
     parser.add_argument('--encoder_ckpt', default='', type=str, help='Encoder checkpoint to resume from')
+    parser.add_argument('--single_gpu', action='store_true', help='Whether to put the encoder and the model on the same gpu (default: false)')
 
     # Optimizer parameters
     parser.add_argument('--weight_decay', type=float, default=0.05, help='Weight decay (default: 0.05)')
+    parser.add_argument('--clip_grad', type=float, default=None, help='Clip gradient norm (default: None, no clipping)')
     parser.add_argument('--max_lr', type=float, default=0.0001, help='max learning rate')
     parser.add_argument('--min_lr', type=float, default=0.00001, help='min learning rate')
     parser.add_argument('--switch_it', type=float, default=900000, help='iteration at which to switch to lower lr')
     parser.add_argument('--num_its', type=float, default=1000001, help='total number of iterations')
+    parser.add_argument('--label_smoothing', type=float, default=0.0, help='Label smoothing for the training loss (default: 0.0)')
 
     # Dataset parameters
     parser.add_argument('--train_data_path', default='', type=str)
     parser.add_argument('--num_workers', default=16, type=int, help='Number of data loading workers.')
+    parser.add_argument('--gpu_decode', action='store_true', help='Whether to decode and augment the training jpegs on the gpu with nvjpeg; images nvjpeg rejects are decoded on the cpu (default: false)')
 
     # Misc
     parser.add_argument('--output_dir', default='./output_dir', help='Path where to save, empty for no saving')
@@ -56,20 +59,35 @@ def main(args):
     print("{}".format(args).replace(', ', ',\n'))
     cudnn.benchmark = True
 
+    # encoder and model are on separate gpus by default, with --single_gpu there is no inter-gpu copy of the encoder outputs
     device_encoder = torch.device('cuda:0')
-    device_model = torch.device('cuda:1')
+    device_model = torch.device('cuda:0') if args.single_gpu else torch.device('cuda:1')
 
-    # training transforms
+    # bf16 has the same exponent range as fp32, so it does not need loss scaling
+    amp_dtype = misc.get_amp_dtype(args.amp_dtype)
+
+    # training transforms (images are kept as uint8 here, normalization happens on the gpu)
     train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(args.input_size, scale=[0.2, 1.0], ratio=[3.0/4.0, 4.0/3.0], interpolation=3),
+        transforms.PILToTensor(),
+        transforms.RandomResizedCrop(args.input_size, scale=[0.2, 1.0], ratio=[3.0/4.0, 4.0/3.0], interpolation=InterpolationMode.BICUBIC, antialias=True),
         transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
     ])
 
+    # persistent_workers and prefetch_factor are only valid with worker processes (num_workers > 0)
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+
     # train and val datasets and loaders
-    train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode("pil").to_tuple("jpg", "cls").map_tuple(train_transform, lambda x: x)
-    train_loader = wds.WebLoader(train_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+    if args.gpu_decode:
+        # workers only shuffle and collate the encoded jpegs, decoding and augmentation happen on the gpu
+        # (decoded images differ in size, so only the crop runs per image; the flip runs on the whole batch)
+        gpu_train_transform = transforms.RandomResizedCrop(args.input_size, scale=[0.2, 1.0], ratio=[3.0/4.0, 4.0/3.0], interpolation=InterpolationMode.BICUBIC, antialias=True)
+        train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode().to_tuple("jpg", "cls").batched(args.batch_size, collation_fn=misc.jpeg_collate)
+        train_loader = wds.WebLoader(train_dataset, batch_size=None, num_workers=args.num_workers, pin_memory=True, **worker_kwargs)
+        train_loader = misc.CudaPrefetchLoader(train_loader, device_encoder, channels_last=True, gpu_decode=True, transform=gpu_train_transform, batch_transform=misc.BatchRandomHorizontalFlip())
+    else:
+        train_dataset = wds.WebDataset(args.train_data_path, resampled=True).shuffle(10000, initial=10000).decode("pil").to_tuple("jpg", "cls").map_tuple(train_transform, lambda x: x).batched(args.batch_size, collation_fn=misc.fast_collate)
+        train_loader = wds.WebLoader(train_dataset, batch_size=None, num_workers=args.num_workers, pin_memory=True, **worker_kwargs)
+        train_loader = misc.CudaPrefetchLoader(train_loader, device_encoder, channels_last=True)
     print(f"Train data loaded.")
 
     # define the model
@@ -80,7 +98,7 @@ def main(args):
 
     # define the encoder
     encoder = tae.__dict__[args.encoder]()
-    encoder.to(device_encoder)
+    encoder.to(device_encoder, memory_format=torch.channels_last)  # nhwc layout for the patch embedding conv
     encoder.eval()
     print(f"Model: {encoder}")
     print(f"Number of params (M): {(sum(p.numel() for p in encoder.parameters() if p.requires_grad) / 1.e6)}")
@@ -88,15 +106,18 @@ def main(args):
     # set wd as 0 for bias and norm layers
     param_groups = misc.add_weight_decay(model, args.weight_decay, bias_wd=False)
     optimizer = torch.optim.AdamW(param_groups, lr=args.max_lr, betas=(0.9, 0.95), fused=True)  # setting fused True for faster updates (hopefully)
-    criterion = torch.nn.CrossEntropyLoss()
-    loss_scaler = NativeScaler()
+    criterion = torch.nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+    loss_scaler = NativeScaler(enabled=amp_dtype == torch.float16)
 
     misc.load_model(args.model_ckpt, model, optimizer=optimizer, loss_scaler=loss_scaler)
     misc.load_model(args.encoder_ckpt, encoder)
 
     model.train()
     metric_logger = misc.MetricLogger(delimiter="  ")
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
+
+    # losses and accuracies are kept on the gpu and only moved to the host when logging (avoids a device sync per iteration)
+    loss_buf, acc_buf, bsize_buf = [], [], []
 
     print("Starting training!")
     # infinite stream for iterable webdataset
@@ -109,37 +130,41 @@ def main(args):
             misc.adjust_learning_rate(optimizer, args.max_lr, args.min_lr, it, args.switch_it)
 
         with torch.no_grad():
-            with torch.cuda.amp.autocast():
-                samples = samples.to(device_encoder, non_blocking=True)
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
                 samples = encoder.forward_encoder(samples)
 
         # move to other gpu
         samples = samples.to(device_model, non_blocking=True)
         targets = targets.to(device_model, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
+        with torch.cuda.amp.autocast(dtype=amp_dtype):
             outputs = model(samples)
             loss = criterion(outputs, targets)
 
         acc1, acc5 = misc.accuracy(outputs, targets, topk=(1, 5))
 
-        loss_value = loss.item()
+        loss_buf.append(loss.detach())
+        acc_buf.append(torch.cat((acc1, acc5)))
+        bsize_buf.append(samples.shape[0])
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
-
-        loss = loss / args.accum_iter
-        loss_scaler(loss, optimizer, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
+        if args.accum_iter > 1:
+            loss = loss / args.accum_iter
+        loss_scaler(loss, optimizer, clip_grad=args.clip_grad, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
         if (it + 1) % args.accum_iter == 0:
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
+
+        # flush buffered losses and accuracies to the host at a bounded cadence, so a diverging run stops early
+        if (it + 1) % args.flush_freq == 0 or (it != 0 and it % args.save_freq == 0):
+            loss_values = misc.flush_losses(loss_buf)
+            acc_values = torch.stack(acc_buf).float().cpu().tolist()
 
-        torch.cuda.synchronize()
+            for loss_value, (acc1_value, acc5_value), bsize in zip(loss_values, acc_values, bsize_buf):
+                metric_logger.update(loss=loss_value)
+                metric_logger.meters['acc1'].update(acc1_value, n=bsize)
+                metric_logger.meters['acc5'].update(acc5_value, n=bsize)
 
-        bsize = samples.shape[0]
-        metric_logger.update(loss=loss_value)
-        metric_logger.meters['acc1'].update(acc1.item(), n=bsize)
-        metric_logger.meters['acc5'].update(acc5.item(), n=bsize)
+            acc_buf.clear()
+            bsize_buf.clear()
 
         if it != 0 and it % args.save_freq == 0:
             # estimate ckpt loss
@@ -129,7 +129,7 @@ def main(args):
 
     model.train()
     metric_logger = misc.MetricLogger(delimiter="  ")
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     best_eval_acc1 = 0.0
 
@@ -158,7 +158,7 @@ def main(args):
             loss = loss / args.accum_iter
             loss_scaler(loss, optimizer, parameters=model.parameters(), update_grad=(it + 1) % args.accum_iter == 0)
             if (it + 1) % args.accum_iter == 0:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
             torch.cuda.synchronize()
 
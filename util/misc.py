@@ -19,6 +19,7 @@ import numpy as np
 import torch
 import torch.distributed as dist
 from torch import inf
+from torchvision.io import decode_image, decode_jpeg, ImageReadMode
 
 
 class SmoothedValue(object):
@@ -245,8 +246,9 @@ def init_distributed_mode(args):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # loss scaling is only needed for fp16; when disabled, scaling and unscaling are no-ops and step just calls optimizer.step()
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -271,6 +273,30 @@ class NativeScalerWithGradNormCount:
         self._scaler.load_state_dict(state_dict)
 
 
+def get_amp_dtype(name):
+    """Map an --amp_dtype name ('fp16' or 'bf16') to the autocast dtype, falling back to fp16 where bf16 is not supported"""
+    if name == 'bf16' and not torch.cuda.is_bf16_supported():
+        print("bf16 is not supported on this device, falling back to fp16.")
+        name = 'fp16'
+    return torch.bfloat16 if name == 'bf16' else torch.float16
+
+
+def flush_losses(loss_buf):
+    """
+    Move a list of buffered gpu losses to the host in a single transfer (clearing the list) and stop training if any of them is not finite.
+    """
+    if not loss_buf:
+        return []
+    loss_values = torch.stack(loss_buf).float().cpu()
+    loss_buf.clear()
+
+    if not torch.isfinite(loss_values).all():
+        print("Loss is {}, stopping training".format(loss_values[~torch.isfinite(loss_values)][0].item()))
+        sys.exit(1)
+
+    return loss_values.tolist()
+
+
 def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
@@ -410,4 +436,125 @@ def adjust_learning_rate(optimizer, max_lr, min_lr, it, switch_it):
         else:
             param_group["lr"] = lr
             
-    return lr
\ No newline at end of file
+    return lr
+
+IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
+
+
+def fast_collate(batch):
+    """
+    Collate (uint8 image tensor, target) pairs into a uint8 image batch and an int64 target batch.
+    Reference: https://github.com/NVIDIA/apex/tree/master/examples/imagenet
+    """
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    imgs = torch.empty((len(batch), *batch[0][0].shape), dtype=torch.uint8)
+    for i, (img, _) in enumerate(batch):
+        imgs[i].copy_(img)
+    return imgs, targets
+
+
+def jpeg_collate(batch):
+    """
+    Collate (encoded jpeg bytes, target) pairs into a list of uint8 byte tensors and an int64 target batch, 
+    leaving the decoding to the gpu (see CudaPrefetchLoader).
+    """
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    imgs = [torch.frombuffer(bytearray(img), dtype=torch.uint8) for img, _ in batch]
+    return imgs, targets
+
+
+class BatchRandomHorizontalFlip(torch.nn.Module):
+    """
+    Horizontally flip each image of a (N, C, H, W) batch with probability p, with one kernel over the whole batch.
+    """
+
+    def __init__(self, p=0.5):
+        super().__init__()
+        self.p = p
+
+    def forward(self, x):
+        flip = torch.rand(x.shape[0], 1, 1, 1, device=x.device) < self.p
+        return torch.where(flip, x.flip(-1), x)
+
+
+class CudaPrefetchLoader:
+    """
+    Wrap a loader yielding uint8 image batches: the next batch is copied to the gpu, cast to float and normalized 
+    on a side stream while the current batch is being processed. Optionally returns the images in channels_last format.
+    With gpu_decode, the loader yields lists of encoded jpegs instead (see jpeg_collate); these are decoded on the gpu 
+    with nvjpeg and each decoded image is passed through transform (which must produce images of the same size). 
+    Images nvjpeg rejects (e.g. CMYK jpegs or pngs stored as .jpg) are decoded on the cpu instead.
+    batch_transform, if given, is applied once to the whole uint8 batch on the gpu.
+    Reference: https://github.com/NVIDIA/apex/tree/master/examples/imagenet
+    """
+
+    def __init__(self, loader, device, mean=IMAGENET_DEFAULT_MEAN, std=IMAGENET_DEFAULT_STD, channels_last=False, gpu_decode=False, transform=None, batch_transform=None):
+        self.loader = loader
+        self.device = device
+        self.gpu_decode = gpu_decode
+        self.transform = transform
+        self.batch_transform = batch_transform
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        # images are in [0, 255] (uint8 or unscaled float), so scale the normalization constants accordingly
+        self.mean = torch.tensor([255 * x for x in mean], device=device).view(1, 3, 1, 1)
+        self.std = torch.tensor([255 * x for x in std], device=device).view(1, 3, 1, 1)
+
+    def _decode(self, samples):
+        try:
+            return decode_jpeg(samples, mode=ImageReadMode.RGB, device=self.device)
+        except RuntimeError:
+            # some image in the batch is not decodable by nvjpeg: retry one by one, falling back to the cpu decoder
+            imgs = []
+            for data in samples:
+                try:
+                    img = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.device)
+                except RuntimeError:
+                    img = decode_image(data, mode=ImageReadMode.RGB).to(self.device)
+                imgs.append(img)
+            return imgs
+
+    def _preload(self, samples, targets, stream):
+        # issue the copy and preprocessing of a batch on the side stream
+        with torch.cuda.stream(stream):
+            if self.gpu_decode:
+                samples = self._decode(samples)
+                samples = torch.stack([self.transform(img) for img in samples])
+            else:
+                samples = samples.to(self.device, non_blocking=True)
+            if self.batch_transform is not None:
+                samples = self.batch_transform(samples)
+            samples = samples.to(dtype=torch.float, memory_format=self.memory_format)
+            samples = samples.sub_(self.mean).div_(self.std)
+            targets = targets.to(self.device, non_blocking=True)
+        return samples, targets
+
+    def _wait(self, samples, targets, stream):
+        # make the current stream wait for the side stream; the tensors were allocated on the side stream but are 
+        # consumed on the current one, so tell the caching allocator
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(stream)
+        samples.record_stream(current_stream)
+        targets.record_stream(current_stream)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+
+        try:
+            next_samples, next_targets = self._preload(*next(loader_iter), stream)
+        except StopIteration:
+            return
+
+        for batch in loader_iter:
+            self._wait(next_samples, next_targets, stream)
+            samples, targets = next_samples, next_targets
+            # start on the next batch before handing over the current one
+            next_samples, next_targets = self._preload(*batch, stream)
+            yield samples, targets
+
+        self._wait(next_samples, next_targets, stream)
+        yield next_samples, next_targets
+
+    def __len__(self):
+        return len(self.loader)